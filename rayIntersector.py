@@ -6,23 +6,891 @@ intersection with scene geometry. The node returns the world space coordinate of
 the first piece of geometry it intersects, or the input transform position if no
 intersection is found.
 
+The raySceneIntersector command wires up nodes and locators for a set of
+transforms, while rayIntersectorBatch traces all of them at once and just
+returns the hit positions.
+
 Author: computerologist
 Date: June 29, 2024
 Version: 0.1
 """
 
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# Numba is optional; without it the kernels below run as plain Python/NumPy
+try:
+    import numba
+except ImportError:
+    numba = None
+
 import maya.api.OpenMaya as om
 import maya.cmds as mc
 
 def maya_useNewAPI():
     pass
 
+# Looked up once here rather than in the om module on every trace
+_K_DEPTHFIRST = om.MItDag.kDepthFirst
+_K_MESH = om.MFn.kMesh
+_K_WORLD = om.MSpace.kWorld
+_INF = float('inf')
+
+# Messages are only formatted if the level is enabled, so debug logging is
+# free in the hot paths unless someone turns it on
+_LOG = logging.getLogger("rayIntersector")
+
+# Scene-wide mesh BVH shared by every rayIntersector node. It is built lazily
+# by getSceneBVH() and thrown away by the scene callbacks whenever a mesh moves
+# or the DAG changes.
+_sceneBVH = None
+# Bumped whenever cached traces may be stale (scene BVH dropped, visibility edited)
+_sceneGeneration = 0
+_sceneCallbackIds = []
+_staleCallbackIds = []
+# Node hash code -> whether the node itself is visible, for the nodes on the
+# paths of meshes in the scene BVH. Kept across rebuilds since moving meshes
+# doesn't change it; an entry is dropped when the node's visibility plugs are
+# dirtied, everything once the DAG itself changes.
+_nodeVisibility = {}
+# Node hash code -> id of the dirty callback watching the node
+_visibilityCallbackIds = {}
+# The visibility and intermediateObject attributes all DAG nodes share, looked
+# up in initializePlugin
+_visibilityAttributes = ()
+
+# fastmath without the no-NaN/no-Inf assumptions, the slab test relies on
+# infinite reciprocals for axis aligned rays
+_FASTMATH = {"nsz", "arcp", "contract", "afn", "reassoc"}
+
+def _njit(**options):
+    """
+    Returns numba.njit(**options) when Numba is available, otherwise a decorator
+    that leaves the function as is.
+    """
+    if numba is None:
+        return lambda function: function
+    return numba.njit(**options)
+
+_prange = numba.prange if numba is not None else range
+
+# Traversal stack depth, enough for 8-wide trees over billions of items
+_STACK_SIZE = 64
+
+def _reciprocal(direction):
+    """
+    Returns 1 / direction for the slab tests. Zero components become
+    infinities, which is what the slab test needs for axis parallel rays.
+    """
+    with np.errstate(divide='ignore'):
+        return 1.0 / direction
+
+def _pathKey(dagPath):
+    """
+    Returns a key for the DAG path that, unlike its fullPathName, survives
+    renames: the hash codes of the nodes along the path, shape first. Every
+    instance of a shape still gets its own key.
+    """
+    path = om.MDagPath(dagPath)
+    key = []
+    while path.length():
+        key.append(om.MObjectHandle(path.node()).hashCode())
+        path.pop(1)
+    return tuple(key)
+
+@_njit(fastmath=_FASTMATH, nogil=True)
+def _intersect8(lo, hi, ro, invdir, tmax):
+    """
+    Slab test of one ray against the 8 child boxes of a BVH node. Taking the
+    per-axis min/max of both slab distances replaces the usual swap on negative
+    directions, so the whole test is branch free.
+
+    Args:
+        lo (np.ndarray): (8, 3) box minimums
+        hi (np.ndarray): (8, 3) box maximums
+        ro (np.ndarray): Ray origin
+        invdir (np.ndarray): Reciprocal of the ray direction
+        tmax (float): Boxes entered beyond this distance are rejected
+
+    Returns:
+        tuple: (mask, tnear) with the hit flag and entry distance of every box
+    """
+    tlo = (lo - ro) * invdir
+    thi = (hi - ro) * invdir
+    tminAxis = np.minimum(tlo, thi)
+    tmaxAxis = np.maximum(tlo, thi)
+    tnear = np.maximum(np.maximum(tminAxis[:, 0], tminAxis[:, 1]), tminAxis[:, 2])
+    tfar = np.minimum(np.minimum(tmaxAxis[:, 0], tmaxAxis[:, 1]), tmaxAxis[:, 2])
+    mask = (tnear <= tfar) & (tfar >= 0.0) & (tnear < tmax)
+    return mask, tnear
+
+def _buildWideBVH(boundsMin, boundsMax, leafSize):
+    """
+    Builds the arrays of a WideBVH over a set of item boxes. Each node splits
+    its items into up to 8 groups by three rounds of median splits along the
+    longest centroid axis; groups of at most leafSize items become leaves,
+    larger ones child nodes.
+
+    Args:
+        boundsMin (np.ndarray): (N, 3) item box minimums
+        boundsMax (np.ndarray): (N, 3) item box maximums
+        leafSize (int): The maximum number of items per leaf
+
+    Returns:
+        tuple: (lo, hi, child, leaves) where leaves lists the item indices of
+        every leaf in leaf order
+    """
+    width = WideBVH.kWidth
+    centroids = (boundsMin + boundsMax) * 0.5
+    nodes = []
+    leaves = []
+
+    def buildNode(indices):
+        nodeIndex = len(nodes)
+        slots = []
+        nodes.append(slots)
+
+        groups = [indices]
+        for _ in range(3):
+            split = []
+            for group in groups:
+                if len(group) <= leafSize:
+                    split.append(group)
+                    continue
+                extent = centroids[group].max(axis=0) - centroids[group].min(axis=0)
+                order = group[np.argsort(centroids[group, int(np.argmax(extent))], kind="stable")]
+                mid = len(order) // 2
+                split.extend((order[:mid], order[mid:]))
+            groups = split
+
+        for group in groups:
+            slotMin = boundsMin[group].min(axis=0)
+            slotMax = boundsMax[group].max(axis=0)
+            if len(group) <= leafSize:
+                slots.append((slotMin, slotMax, True, len(leaves)))
+                leaves.append(group)
+            else:
+                slots.append((slotMin, slotMax, False, buildNode(group)))
+
+        return nodeIndex
+
+    if len(boundsMin):
+        buildNode(np.arange(len(boundsMin)))
+
+    # Round the float32 boxes outwards so they never shrink below the items
+    nodeCount = len(nodes)
+    lo = np.full((nodeCount, width, 3), np.inf, dtype=np.float32)
+    hi = np.full((nodeCount, width, 3), -np.inf, dtype=np.float32)
+    child = np.full((nodeCount, width), WideBVH.kEmpty, dtype=np.int32)
+    for k, slots in enumerate(nodes):
+        for i, (slotMin, slotMax, isLeaf, index) in enumerate(slots):
+            lo[k, i] = np.nextafter(slotMin.astype(np.float32), np.float32(-np.inf))
+            hi[k, i] = np.nextafter(slotMax.astype(np.float32), np.float32(np.inf))
+            child[k, i] = nodeCount + index if isLeaf else index
+
+    return lo, hi, child, leaves
+
+class WideBVH(object):
+    """
+    8-wide bounding volume hierarchy stored as flat arrays.
+
+    Node k stores the boxes of its children in lo[k] and hi[k] (float32, 8x3)
+    and their references in child[k]: an index below nodeCount is another node,
+    nodeCount + i is leaf i and kEmpty marks unused slots.
+    """
+    kWidth = 8
+    kEmpty = -1
+    kStackSize = _STACK_SIZE
+
+    def __init__(self, lo, hi, child):
+        self.lo = lo
+        self.hi = hi
+        self.child = child
+        self.nodeCount = len(child)
+
+    def traverse(self, ro, invdir, intersectLeaf, maxDistance=_INF, anyHit=False):
+        """
+        Walks the hierarchy nearest first, calling intersectLeaf on every leaf
+        whose box the ray enters before the best hit found so far.
+
+        Args:
+            ro (np.ndarray): Ray origin
+            invdir (np.ndarray): Reciprocal of the ray direction
+            intersectLeaf (callable): intersectLeaf(index, maxDistance) tests
+                leaf index and returns a (distance, hit) tuple or None
+            maxDistance (float): Hits at or beyond this distance are ignored
+            anyHit (bool): Stop at the first leaf hit instead of the closest one
+
+        Returns:
+            tuple: (distance, hit) of the closest hit, or (maxDistance, None)
+        """
+        closestDistance = maxDistance
+        closestHit = None
+        if not self.nodeCount:
+            return closestDistance, closestHit
+
+        lo = self.lo
+        hi = self.hi
+        child = self.child
+        nodeCount = self.nodeCount
+        empty = self.kEmpty
+        intersect8 = _intersect8
+
+        # Node and leaf references share one stack so both come off it nearest
+        # first, each with the distance at which the ray enters its box
+        stack = [0] * self.kStackSize
+        stackNear = [0.0] * self.kStackSize
+        top = 1
+        while top:
+            top -= 1
+            ref = stack[top]
+            # Skip boxes a hit found since they were pushed already beats
+            if stackNear[top] >= closestDistance:
+                continue
+
+            if ref < nodeCount:
+                mask, tnear = intersect8(lo[ref], hi[ref], ro, invdir, closestDistance)
+                refs = child[ref]
+                # Farthest child is pushed first so the nearest is popped first
+                for i in np.argsort(tnear)[::-1]:
+                    if mask[i] and refs[i] != empty:
+                        stack[top] = int(refs[i])
+                        stackNear[top] = tnear[i]
+                        top += 1
+                continue
+
+            leafHit = intersectLeaf(ref - nodeCount, closestDistance)
+            if leafHit is not None and leafHit[0] < closestDistance:
+                closestDistance, closestHit = leafHit
+                if anyHit:
+                    break
+
+        return closestDistance, closestHit
+
+class SceneBVH(WideBVH):
+    """
+    WideBVH over the world space bounding boxes of every mesh in the scene,
+    leaf i holding the mesh dagPaths[i] whose mesh cache key is keys[i].
+    """
+    kVisibilityAttributes = ("visibility", "intermediateObject")
+
+    def __init__(self, lo, hi, child, dagPaths, callbackIds, keys):
+        super(SceneBVH, self).__init__(lo, hi, child)
+        self.dagPaths = dagPaths
+        self.callbackIds = callbackIds
+        self.keys = keys
+        self.leafVisible = None
+
+    @classmethod
+    def build(cls):
+        """
+        Collects all meshes in the scene and builds the hierarchy over them.
+
+        Returns:
+            SceneBVH: The new hierarchy
+        """
+        dagPaths = []
+        keys = []
+        boundsMin = []
+        boundsMax = []
+        callbackIds = []
+        dagIterator = om.MItDag(_K_DEPTHFIRST, _K_MESH)
+        while not dagIterator.isDone():
+            dagPath = dagIterator.getPath()
+            # The key stays valid if nodes on the path are renamed later
+            key = _pathKey(dagPath)
+
+            # Deforming the mesh only shows up as outMesh being dirtied. Watched
+            # for empty meshes too, so they are picked up once they get geometry
+            callbackIds.append(om.MNodeMessage.addNodeDirtyPlugCallback(dagPath.node(), _onMeshDirty, key))
+
+            # Leave out meshes closestIntersection can't handle so tracing
+            # never has to guard against them
+            if om.MFnMesh(dagPath).numPolygons == 0:
+                dagIterator.next()
+                continue
+
+            bbox = om.MFnDagNode(dagPath).boundingBox
+            bbox.transformUsing(dagPath.inclusiveMatrix())
+            boundsMin.append((bbox.min.x, bbox.min.y, bbox.min.z))
+            boundsMax.append((bbox.max.x, bbox.max.y, bbox.max.z))
+            dagPaths.append(dagPath)
+            keys.append(key)
+
+            # Moving the mesh (or any of its parents) invalidates its box
+            callbackIds.append(om.MDagMessage.addWorldMatrixModifiedCallback(dagPath, _onMeshMoved, key))
+
+            dagIterator.next()
+
+        return cls.fromBounds(boundsMin, boundsMax, dagPaths, callbackIds, keys)
+
+    @classmethod
+    def fromBounds(cls, boundsMin, boundsMax, dagPaths, callbackIds, keys=None):
+        """
+        Builds the hierarchy over the given mesh boxes.
+
+        Args:
+            boundsMin (list): (x, y, z) box minimum of every mesh
+            boundsMax (list): (x, y, z) box maximum of every mesh
+            dagPaths (list): The mesh of every box
+            callbackIds (list): Callbacks to remove once the hierarchy is dropped
+            keys (list): The mesh cache key of every box, defaults to dagPaths
+
+        Returns:
+            SceneBVH: The new hierarchy
+        """
+        if keys is None:
+            keys = dagPaths
+        lo, hi, child, leaves = _buildWideBVH(np.array(boundsMin, dtype=np.float64).reshape(-1, 3),
+                                              np.array(boundsMax, dtype=np.float64).reshape(-1, 3), 1)
+        order = [int(leaf[0]) for leaf in leaves]
+        return cls(lo, hi, child, [dagPaths[i] for i in order], callbackIds, [keys[i] for i in order])
+
+    def getLeafVisibility(self):
+        """
+        Returns the per leaf visibility flags, looking them up again if a
+        visibility plug was dirtied since the last call.
+        """
+        if self.leafVisible is None:
+            self.leafVisible = [isPathVisible(dagPath, key) for dagPath, key in zip(self.dagPaths, self.keys)]
+        return self.leafVisible
+
+    def closestIntersection(self, raySource, rayDirection):
+        """
+        Returns the closest intersection of the ray with the visible meshes
+        in the hierarchy, only testing meshes whose bounds the ray enters
+        before the best hit found so far.
+
+        Args:
+            raySource (om.MFloatPoint): The starting point of the ray
+            rayDirection (om.MFloatVector): The direction of the ray
+
+        Returns:
+            om.MPoint or None: The closest intersection point, or None if no intersection is found
+        """
+        return self._intersectMeshes(raySource, rayDirection, True)
+
+    def anyIntersection(self, raySource, rayDirection):
+        """
+        Returns the first intersection found of the ray with the visible
+        meshes, which isn't necessarily the closest. Cheaper than
+        closestIntersection when only whether the ray hits anything matters.
+
+        Args:
+            raySource (om.MFloatPoint): The starting point of the ray
+            rayDirection (om.MFloatVector): The direction of the ray
+
+        Returns:
+            om.MPoint or None: An intersection point, or None if no intersection is found
+        """
+        return self._intersectMeshes(raySource, rayDirection, False)
+
+    def _intersectMeshes(self, raySource, rayDirection, findClosest):
+        ro = np.array((raySource.x, raySource.y, raySource.z), dtype=np.float64)
+        # Computed once and shared by every box test of the trace
+        invdir = _reciprocal(np.array((rayDirection.x, rayDirection.y, rayDirection.z), dtype=np.float64))
+
+        leafVisible = self.getLeafVisibility()
+
+        def intersectLeaf(index, maxDistance):
+            # Check if the mesh or its transform is visible
+            if not leafVisible[index]:
+                return None
+
+            fnMesh, accelParams = RayIntersector.getMeshAccel(self.dagPaths[index], self.keys[index])
+            #  intersection test, only meshes that can be intersected are in the hierarchy.
+            #  Passing the best distance so far lets Maya stop early on this mesh too
+            intersect = fnMesh.closestIntersection if findClosest else fnMesh.anyIntersection
+            hit = intersect(
+                raySource, rayDirection, _K_WORLD, maxDistance, False, accelParams=accelParams
+            )
+
+            # A miss comes back as None or with a face index of -1
+            if hit is None or hit[2] == -1:
+                return None
+            hitPoint = hit[0]
+            return (hitPoint - raySource).length(), om.MPoint(hitPoint)
+
+        intersectionPoint = self.traverse(ro, invdir, intersectLeaf, anyHit=not findClosest)[1]
+        return intersectionPoint  # This will be None if no intersection was found
+
+    def snapshotMeshes(self, leaves):
+        """
+        Collects the world space triangles of the given leaves so their rays
+        can be traced without touching the DAG. Must be called from the main
+        thread.
+
+        Args:
+            leaves (iterable): The leaf indices
+
+        Returns:
+            dict: Leaf index -> MeshTriangles
+        """
+        return {leaf: RayIntersector.getMeshTriangles(self.dagPaths[leaf], self.keys[leaf]) for leaf in leaves}
+
+    def candidateLeaves(self, origins, invdirs, leafMask):
+        """
+        Returns the ray/leaf pairs of every flagged leaf whose bounds a ray
+        enters. Only reads NumPy data and runs in a kernel that releases the
+        GIL, so it is safe and worthwhile to call from worker threads.
+
+        Args:
+            origins (np.ndarray): (N, 3) ray origins
+            invdirs (np.ndarray): (N, 3) reciprocals of the ray directions
+            leafMask (np.ndarray): (L,) bool flag per leaf, unflagged leaves are skipped
+
+        Returns:
+            tuple: (rays, leaves) index arrays with one entry per pair
+        """
+        return _candidateLeavesKernel(self.lo, self.hi, self.child, leafMask, origins, invdirs)
+
+    def closestTriangleHits(self, origins, directions):
+        """
+        Traces many rays against the triangles of the visible meshes. The
+        rays are first matched to the meshes whose bounds they enter, in
+        chunks on a thread pool, so only those meshes get snapshotted; then
+        every mesh traces all of its rays in one batched kernel call. Must be
+        called from the main thread.
+
+        Args:
+            origins (np.ndarray): (N, 3) ray origins
+            directions (np.ndarray): (N, 3) normalized ray directions
+
+        Returns:
+            np.ndarray: (N,) distance to the closest hit of every ray, inf if
+            the ray hits nothing
+        """
+        # Computed once for all rays and shared by the box tests of every mesh
+        invdirs = _reciprocal(directions)
+        leafMask = np.array(self.getLeafVisibility(), dtype=np.bool_).reshape(-1)
+
+        chunks = np.array_split(np.arange(len(origins)), os.cpu_count() or 1)
+        with ThreadPoolExecutor(max_workers=len(chunks)) as executor:
+            pairs = list(executor.map(lambda chunk: self.candidateLeaves(origins[chunk], invdirs[chunk], leafMask),
+                                      chunks))
+        # Chunk local ray indices back to global ones
+        rays = np.concatenate([chunk[chunkRays] for chunk, (chunkRays, _) in zip(chunks, pairs)])
+        leaves = np.concatenate([chunkLeaves for _, chunkLeaves in pairs])
+
+        # Group the rays by leaf
+        order = np.argsort(leaves, kind="stable")
+        rays = rays[order]
+        leaves, starts = np.unique(leaves[order], return_index=True)
+
+        # Building the triangle BVHs is by far the slowest part, meshes no
+        # ray comes near are never snapshotted
+        meshes = self.snapshotMeshes(leaves)
+
+        distances = np.full(len(origins), _INF)
+        for leaf, leafRays in zip(leaves, np.split(rays, starts[1:])):
+            distances[leafRays] = meshes[leaf].closestHits(origins[leafRays], directions[leafRays],
+                                                           invdirs[leafRays], distances[leafRays])
+        return distances
+
+@_njit(fastmath=_FASTMATH, cache=True, nogil=True)
+def _candidateLeavesKernel(lo, hi, child, leafMask, origins, invdirs):
+    """
+    Finds the leaves of a WideBVH whose boxes each ray enters, visiting every
+    entered box since there are no hits to cull against yet.
+
+    Args:
+        lo, hi, child (np.ndarray): The WideBVH arrays
+        leafMask (np.ndarray): Per leaf flag, unflagged leaves are skipped
+        origins, invdirs (np.ndarray): (R, 3) per ray arrays
+
+    Returns:
+        tuple: (rays, leaves) index arrays with one entry per ray/leaf pair
+    """
+    nodeCount = child.shape[0]
+    capacity = origins.shape[0] + 16
+    rays = np.empty(capacity, dtype=np.int64)
+    leaves = np.empty(capacity, dtype=np.int64)
+    count = 0
+    if nodeCount == 0:
+        return rays[:0], leaves[:0]
+
+    stack = np.empty(_STACK_SIZE, dtype=np.int64)
+    for r in range(origins.shape[0]):
+        ro = origins[r]
+        invdir = invdirs[r]
+        stack[0] = 0
+        top = 1
+        while top > 0:
+            top -= 1
+            ref = stack[top]
+            if ref < nodeCount:
+                mask, tnear = _intersect8(lo[ref], hi[ref], ro, invdir, np.inf)
+                for i in range(child.shape[1]):
+                    if mask[i] and child[ref, i] != -1:  # WideBVH.kEmpty
+                        stack[top] = child[ref, i]
+                        top += 1
+                continue
+
+            leaf = ref - nodeCount
+            if not leafMask[leaf]:
+                continue
+            if count == capacity:
+                capacity *= 2
+                grownRays = np.empty(capacity, dtype=np.int64)
+                grownLeaves = np.empty(capacity, dtype=np.int64)
+                grownRays[:count] = rays[:count]
+                grownLeaves[:count] = leaves[:count]
+                rays = grownRays
+                leaves = grownLeaves
+            rays[count] = r
+            leaves[count] = leaf
+            count += 1
+
+    return rays[:count], leaves[:count]
+
+class MeshTriangles(object):
+    """
+    World space triangles of a mesh with their own WideBVH.
+
+    The triangles are stored as float32 (T, 3) arrays of the first vertex and
+    the two edge vectors, reordered so every leaf owns the contiguous range
+    leafStart[i]:leafEnd[i]. Ranges are padded to a multiple of kBlockSize with
+    degenerate triangles, which never pass the determinant test.
+    """
+    kBlockSize = 8
+
+    def __init__(self, v0, v1, v2):
+        boundsMin = np.minimum(np.minimum(v0, v1), v2)
+        boundsMax = np.maximum(np.maximum(v0, v1), v2)
+        lo, hi, child, leaves = _buildWideBVH(boundsMin, boundsMax, self.kBlockSize)
+        self.bvh = WideBVH(lo, hi, child)
+
+        block = self.kBlockSize
+        sizes = np.array([-(-len(leaf) // block) * block for leaf in leaves], dtype=np.int64)
+        self.leafEnd = np.cumsum(sizes)
+        self.leafStart = self.leafEnd - sizes
+
+        gather = np.full(int(sizes.sum()), -1, dtype=np.int64)
+        for leaf, start in zip(leaves, self.leafStart):
+            gather[start:start + len(leaf)] = leaf
+        padding = gather < 0
+
+        self.v0 = v0[gather].astype(np.float32)
+        self.e1 = (v1[gather] - v0[gather]).astype(np.float32)
+        self.e2 = (v2[gather] - v0[gather]).astype(np.float32)
+        for array in (self.v0, self.e1, self.e2):
+            array[padding] = 0.0
+
+    @classmethod
+    def fromDagPath(cls, dagPath):
+        """
+        Collects the world space triangles of a mesh.
+
+        Args:
+            dagPath (om.MDagPath): The DAG path of the mesh
+
+        Returns:
+            MeshTriangles: The triangles of the mesh
+        """
+        fnMesh = om.MFnMesh(dagPath)
+        _, triangleVertices = fnMesh.getTriangles()
+        points = np.array([(p.x, p.y, p.z) for p in fnMesh.getPoints(_K_WORLD)], dtype=np.float64)
+        vertices = np.array(triangleVertices, dtype=np.int64).reshape(-1, 3)
+        return cls(points[vertices[:, 0]], points[vertices[:, 1]], points[vertices[:, 2]])
+
+    def closestHits(self, origins, directions, invdirs, maxDistances):
+        """
+        Traces many rays against the triangles in one kernel call.
+
+        Returns:
+            np.ndarray: Per ray distance to the closest hit, or its maxDistances
+            entry if no triangle is hit before it
+        """
+        bvh = self.bvh
+        return _traceRaysKernel(bvh.lo, bvh.hi, bvh.child, self.leafStart, self.leafEnd,
+                                self.v0, self.e1, self.e2, origins, directions, invdirs, maxDistances)
+
+@_njit(fastmath=_FASTMATH, cache=True, nogil=True)
+def _moellerTrumboreBatch(v0, e1, e2, ro, rd, tmax):
+    """
+    Moeller-Trumbore test of one ray against a set of triangles, both faces
+    counting as hits.
+
+    Args:
+        v0 (np.ndarray): (T, 3) first triangle vertices
+        e1 (np.ndarray): (T, 3) first triangle edges
+        e2 (np.ndarray): (T, 3) second triangle edges
+        ro (np.ndarray): Ray origin
+        rd (np.ndarray): Ray direction
+        tmax (float): Hits at or beyond this distance are ignored
+
+    Returns:
+        tuple: (t, u, v, index) of the closest hit, index is -1 and t is tmax
+        if there is none
+    """
+    bestT = tmax
+    bestU = 0.0
+    bestV = 0.0
+    bestIndex = -1
+    for i in range(v0.shape[0]):
+        px = rd[1] * e2[i, 2] - rd[2] * e2[i, 1]
+        py = rd[2] * e2[i, 0] - rd[0] * e2[i, 2]
+        pz = rd[0] * e2[i, 1] - rd[1] * e2[i, 0]
+        det = e1[i, 0] * px + e1[i, 1] * py + e1[i, 2] * pz
+        if abs(det) <= 1e-12:
+            continue
+        invDet = 1.0 / det
+
+        tx = ro[0] - v0[i, 0]
+        ty = ro[1] - v0[i, 1]
+        tz = ro[2] - v0[i, 2]
+        u = (tx * px + ty * py + tz * pz) * invDet
+        if u < 0.0 or u > 1.0:
+            continue
+
+        qx = ty * e1[i, 2] - tz * e1[i, 1]
+        qy = tz * e1[i, 0] - tx * e1[i, 2]
+        qz = tx * e1[i, 1] - ty * e1[i, 0]
+        v = (rd[0] * qx + rd[1] * qy + rd[2] * qz) * invDet
+        if v < 0.0 or u + v > 1.0:
+            continue
+
+        t = (e2[i, 0] * qx + e2[i, 1] * qy + e2[i, 2] * qz) * invDet
+        if t > 0.0 and t < bestT:
+            bestT = t
+            bestU = u
+            bestV = v
+            bestIndex = i
+    return bestT, bestU, bestV, bestIndex
+
+def _moellerTrumboreVectorized(v0, e1, e2, ro, rd, tmax):
+    """
+    NumPy version of _moellerTrumboreBatch, used when Numba isn't available
+    since the explicit loop would be far slower as plain Python.
+    """
+    pvec = np.cross(rd, e2)
+    det = np.einsum('ij,ij->i', e1, pvec)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        invDet = 1.0 / det
+        tvec = ro - v0
+        u = np.einsum('ij,ij->i', tvec, pvec) * invDet
+        qvec = np.cross(tvec, e1)
+        v = qvec.dot(rd) * invDet
+        t = np.einsum('ij,ij->i', e2, qvec) * invDet
+        hit = (np.abs(det) > 1e-12) & (u >= 0.0) & (v >= 0.0) & (u + v <= 1.0) & (t > 0.0) & (t < tmax)
+
+    if not hit.any():
+        return tmax, 0.0, 0.0, -1
+    index = int(np.argmin(np.where(hit, t, np.inf)))
+    return float(t[index]), float(u[index]), float(v[index]), index
+
+if numba is None:
+    _moellerTrumboreBatch = _moellerTrumboreVectorized
+
+@_njit(fastmath=_FASTMATH, cache=True, nogil=True)
+def _traceRayKernel(lo, hi, child, leafStart, leafEnd, v0, e1, e2, ro, rd, invdir, tmax):
+    """
+    Traces one ray through a MeshTriangles hierarchy: the nearest first BVH
+    descent and the leaf triangle tests in a single compiled call, so no
+    Python runs per node or per leaf.
+
+    Args:
+        lo, hi, child (np.ndarray): The WideBVH arrays
+        leafStart, leafEnd (np.ndarray): Triangle range of every leaf
+        v0, e1, e2 (np.ndarray): The triangle arrays
+        ro (np.ndarray): Ray origin
+        rd (np.ndarray): Ray direction
+        invdir (np.ndarray): Reciprocal of the ray direction
+        tmax (float): Hits at or beyond this distance are ignored
+
+    Returns:
+        tuple: (t, index) of the closest hit, index is -1 and t is tmax if
+        there is none
+    """
+    bestT = tmax
+    bestIndex = -1
+    nodeCount = child.shape[0]
+    if nodeCount == 0:
+        return bestT, bestIndex
+
+    stack = np.empty(_STACK_SIZE, dtype=np.int64)
+    stackNear = np.empty(_STACK_SIZE, dtype=np.float64)
+    stack[0] = 0
+    stackNear[0] = 0.0
+    top = 1
+    while top > 0:
+        top -= 1
+        ref = stack[top]
+        # Skip boxes a hit found since they were pushed already beats
+        if stackNear[top] >= bestT:
+            continue
+
+        if ref < nodeCount:
+            mask, tnear = _intersect8(lo[ref], hi[ref], ro, invdir, bestT)
+            # Farthest child is pushed first so the nearest is popped first
+            order = np.argsort(tnear)[::-1]
+            for j in range(order.shape[0]):
+                i = order[j]
+                if mask[i] and child[ref, i] != -1:  # WideBVH.kEmpty
+                    stack[top] = child[ref, i]
+                    stackNear[top] = tnear[i]
+                    top += 1
+            continue
+
+        start = leafStart[ref - nodeCount]
+        end = leafEnd[ref - nodeCount]
+        t, u, v, triangle = _moellerTrumboreBatch(v0[start:end], e1[start:end], e2[start:end], ro, rd, bestT)
+        if triangle >= 0 and t < bestT:
+            bestT = t
+            bestIndex = start + triangle
+
+    return bestT, bestIndex
+
+@_njit(fastmath=_FASTMATH, cache=True, nogil=True, parallel=True)
+def _traceRaysKernel(lo, hi, child, leafStart, leafEnd, v0, e1, e2, origins, directions, invdirs, tmax):
+    """
+    Runs _traceRayKernel for many rays against the same mesh, in parallel
+    when compiled with Numba.
+
+    Args:
+        origins, directions, invdirs (np.ndarray): (R, 3) per ray arrays
+        tmax (np.ndarray): (R,) per ray hit distance limits
+
+    Returns:
+        np.ndarray: (R,) distance to the closest hit of every ray, tmax if there is none
+    """
+    rayCount = origins.shape[0]
+    t = np.empty(rayCount, dtype=np.float64)
+    for r in _prange(rayCount):
+        t[r] = _traceRayKernel(lo, hi, child, leafStart, leafEnd, v0, e1, e2,
+                               origins[r], directions[r], invdirs[r], tmax[r])[0]
+    return t
+
+def getSceneBVH():
+    """
+    Returns the cached scene hierarchy, building it first if the scene changed
+    since the last call.
+    """
+    global _sceneBVH
+    if _sceneBVH is None:
+        # Callbacks can't safely remove themselves, so the ones belonging to
+        # the previous hierarchy are cleaned up here instead
+        if _staleCallbackIds:
+            om.MMessage.removeCallbacks(_staleCallbackIds)
+            del _staleCallbackIds[:]
+        _sceneBVH = SceneBVH.build()
+    return _sceneBVH
+
+def invalidateSceneBVH():
+    """
+    Drops the cached scene hierarchy so the next trace rebuilds it.
+    """
+    global _sceneBVH, _sceneGeneration
+    _sceneGeneration += 1
+    if _sceneBVH is not None:
+        _staleCallbackIds.extend(_sceneBVH.callbackIds)
+        _sceneBVH = None
+
+def isPathVisible(dagPath, key):
+    """
+    Returns whether a mesh counts as visible: neither it nor any of its
+    parents is hidden or an intermediate object. The flags are cached per
+    node, and a node is only watched for visibility changes once it has been
+    looked up, so only the parents of meshes in the scene BVH are watched.
+
+    Args:
+        dagPath (om.MDagPath): The DAG path of the mesh
+        key (tuple): Its _pathKey, the hash code of every node on the path
+
+    Returns:
+        bool: True if the mesh is visible
+    """
+    for depth, nodeKey in enumerate(key):
+        visible = _nodeVisibility.get(nodeKey)
+        if visible is None:
+            path = om.MDagPath(dagPath)
+            if depth:
+                path.pop(depth)
+            visible = _nodeVisibility[nodeKey] = _readNodeVisibility(path.node(), nodeKey)
+        if not visible:
+            return False
+    return True
+
+def _readNodeVisibility(node, nodeKey):
+    """
+    Reads whether the node itself is visible, watching it for changes the
+    first time.
+    """
+    currentNode = om.MFnDependencyNode(node)
+    visible = True
+    if currentNode.hasAttribute("visibility"):
+        visible = currentNode.findPlug("visibility", False).asBool()
+    # Intermediate objects (e.g. deformer inputs) never count as visible
+    if visible and currentNode.hasAttribute("intermediateObject"):
+        visible = not currentNode.findPlug("intermediateObject", False).asBool()
+
+    if nodeKey not in _visibilityCallbackIds:
+        _visibilityCallbackIds[nodeKey] = om.MNodeMessage.addNodeDirtyPlugCallback(node, _onVisibilityDirty,
+                                                                                   nodeKey)
+    return visible
+
+def invalidateVisibility():
+    """
+    Drops the cached visibility together with its callbacks, e.g. once DAG
+    nodes were added or deleted.
+    """
+    _nodeVisibility.clear()
+    _staleCallbackIds.extend(_visibilityCallbackIds.values())
+    _visibilityCallbackIds.clear()
+
+def _onSceneChanged(*args):
+    invalidateSceneBVH()
+    invalidateVisibility()
+    RayIntersector.clearMeshCache()
+
+def _onVisibilityDirty(node, plug, nodeKey):
+    # Dirtying covers setAttr as well as keyed or connected plugs changing,
+    # which never send an attribute changed message. Runs for every dirtied
+    # plug of the node, so only cheap MObject comparisons happen here
+    global _sceneGeneration
+    if plug.attribute() in _visibilityAttributes:
+        _nodeVisibility.pop(nodeKey, None)
+        if _sceneBVH is not None:
+            _sceneBVH.leafVisible = None
+        _sceneGeneration += 1
+
+def _onMeshMoved(transformNode, modified, key):
+    # Only the world space data of the mesh is stale, the acceleration grid is kept
+    RayIntersector._triangleCache.pop(key, None)
+    invalidateSceneBVH()
+
+def _onMeshDirty(node, plug, key):
+    # Any change to the geometry dirties outMesh, which stales the cached
+    # acceleration grid, the triangles and the mesh bounds in the scene BVH
+    if plug.partialName(useLongNames=True) == "outMesh":
+        RayIntersector.clearMeshCache(key)
+        invalidateSceneBVH()
+
 class RayIntersector(om.MPxNode):
     kNodeName = "rayIntersector"
     kNodeId = om.MTypeId(0x00100010)
 
+    # (matrix row, sign) of the ray direction for each rayAxis enum value
+    _AXIS_TABLE = [(0, 1), (1, 1), (2, 1), (0, -1), (1, -1), (2, -1)]
+
+    # Path key (see _pathKey) -> (MFnMesh, MMeshIsectAccelParams), shared by all nodes
+    _accelCache = {}
+    # Path key -> MeshTriangles, dropped together with the _accelCache entry
+    _triangleCache = {}
+
     def __init__(self):
         super(RayIntersector, self).__init__()
+        # Inputs of the last trace, its result is reused while nothing changed
+        self._lastMatrix = None
+        self._lastAxis = None
+        self._lastFindClosest = None
+        self._lastGeneration = None
+        # Written in place each compute so steady state playback allocates
+        # nothing; also holds the result of the last trace
+        self._outVec = om.MFloatVector()
 
     @classmethod
     def creator(cls):
@@ -52,12 +920,20 @@ class RayIntersector(om.MPxNode):
         eAttr.readable = True
         eAttr.writable = True
 
+        # When off, any hit will do (e.g. occlusion tests), which lets the trace stop early
+        cls.findClosestAttr = nAttr.create("findClosest", "fc", om.MFnNumericData.kBoolean, True)
+        nAttr.storable = True
+        nAttr.readable = True
+        nAttr.writable = True
+
         cls.addAttribute(cls.inputMatrixAttr)
         cls.addAttribute(cls.outputTranslateAttr)
         cls.addAttribute(cls.rayAxisAttr)
+        cls.addAttribute(cls.findClosestAttr)
 
         cls.attributeAffects(cls.inputMatrixAttr, cls.outputTranslateAttr)
         cls.attributeAffects(cls.rayAxisAttr, cls.outputTranslateAttr)
+        cls.attributeAffects(cls.findClosestAttr, cls.outputTranslateAttr)
 
     def compute(self, plug, dataBlock):
         if plug == self.outputTranslateAttr:
@@ -67,52 +943,54 @@ class RayIntersector(om.MPxNode):
                 
                 rayAxisHandle = dataBlock.inputValue(self.rayAxisAttr)
                 rayAxis = rayAxisHandle.asShort()
+                # Values outside the enum trace -Z like the default
+                if not 0 <= rayAxis < len(RayIntersector._AXIS_TABLE):
+                    rayAxis = 5
+
+                findClosest = dataBlock.inputValue(self.findClosestAttr).asBool()
                 
-                transformPosition = om.MPoint(inputMatrix.getElement(3, 0),
-                                           inputMatrix.getElement(3, 1),
-                                           inputMatrix.getElement(3, 2))
+                outputHandle = dataBlock.outputValue(self.outputTranslateAttr)
+
+                # Dirty propagation often recomputes the node with unchanged
+                # inputs, skip the trace if the scene didn't change either
+                if (self._lastMatrix is not None and rayAxis == self._lastAxis
+                        and findClosest == self._lastFindClosest
+                        and self._lastGeneration == _sceneGeneration
+                        and inputMatrix.isEquivalent(self._lastMatrix)):
+                    outputHandle.setMFloatVector(self._outVec)
+                    dataBlock.setClean(plug)
+                    return
+
+                # Copy the 16 doubles out in one go (row major) rather than
+                # calling getElement once per entry
+                m = tuple(inputMatrix)
+                transformPosition = om.MPoint(m[12], m[13], m[14])
                 
                 # Extract transform direction based on selected axis
-                if rayAxis == 0:  # X
-                    transformDirection = om.MVector(inputMatrix.getElement(0, 0),
-                                                 inputMatrix.getElement(0, 1),
-                                                 inputMatrix.getElement(0, 2)).normal()
-                elif rayAxis == 1:  # Y
-                    transformDirection = om.MVector(inputMatrix.getElement(1, 0),
-                                                 inputMatrix.getElement(1, 1),
-                                                 inputMatrix.getElement(1, 2)).normal()
-                elif rayAxis == 2:  # Z
-                    transformDirection = om.MVector(inputMatrix.getElement(2, 0),
-                                                 inputMatrix.getElement(2, 1),
-                                                 inputMatrix.getElement(2, 2)).normal()
-                elif rayAxis == 3:  # -X
-                    transformDirection = om.MVector(-inputMatrix.getElement(0, 0),
-                                                 -inputMatrix.getElement(0, 1),
-                                                 -inputMatrix.getElement(0, 2)).normal()
-                elif rayAxis == 4:  # -Y
-                    transformDirection = om.MVector(-inputMatrix.getElement(1, 0),
-                                                 -inputMatrix.getElement(1, 1),
-                                                 -inputMatrix.getElement(1, 2)).normal()
-                else:  # -Z (default)
-                    transformDirection = om.MVector(-inputMatrix.getElement(2, 0),
-                                                 -inputMatrix.getElement(2, 1),
-                                                 -inputMatrix.getElement(2, 2)).normal()
-
-                intersectionPoint = self.traceRay(transformPosition, transformDirection)
+                row, sign = RayIntersector._AXIS_TABLE[rayAxis]
+                r = 4 * row
+                transformDirection = om.MVector(sign * m[r], sign * m[r + 1], sign * m[r + 2]).normal()
 
-                outputHandle = dataBlock.outputValue(self.outputTranslateAttr)
-                if intersectionPoint:
-                    outputHandle.setMFloatVector(om.MFloatVector(intersectionPoint))
-                else:
-                    outputHandle.setMFloatVector(om.MFloatVector(transformPosition))
+                intersectionPoint = self.traceRay(transformPosition, transformDirection, findClosest)
+
+                if intersectionPoint is None:
+                    intersectionPoint = transformPosition
+                outVec = self._outVec
+                outVec.x, outVec.y, outVec.z = intersectionPoint.x, intersectionPoint.y, intersectionPoint.z
+                outputHandle.setMFloatVector(outVec)
+
+                self._lastMatrix = om.MMatrix(inputMatrix)
+                self._lastAxis = rayAxis
+                self._lastFindClosest = findClosest
+                self._lastGeneration = _sceneGeneration
 
                 dataBlock.setClean(plug)
                 
             except Exception as e:
-                print(f"Error in compute: {str(e)}")
+                _LOG.error("Error in compute: %s", e)
                 return
 
-    def traceRay(self, origin, direction):
+    def traceRay(self, origin, direction, findClosest=True):
         """
         Traces a ray from the given origin in the given direction and returns
         the closest intersection point with visible scene geometry.
@@ -120,6 +998,7 @@ class RayIntersector(om.MPxNode):
         Args:
             origin (om.MPoint): The starting point of the ray
             direction (om.MVector): The direction of the ray
+            findClosest (bool): If False, return the first hit found instead of the closest
 
         Returns:
             om.MPoint or None: The closest intersection point, or None if no intersection is found
@@ -128,154 +1007,214 @@ class RayIntersector(om.MPxNode):
         raySource = om.MFloatPoint(origin)
         rayDirection = om.MFloatVector(direction)
 
-        # Prepare for intersection test
-        dagIterator = om.MItDag(om.MItDag.kDepthFirst, om.MFn.kMesh)
-        intersectionPoint = None
-        closestDistance = float('inf')
-
-        while not dagIterator.isDone():
-            dagPath = dagIterator.getPath()
+        if findClosest:
+            return getSceneBVH().closestIntersection(raySource, rayDirection)
+        return getSceneBVH().anyIntersection(raySource, rayDirection)
 
-            # Check if the mesh or its transform is visible
-            if self.isVisible(dagPath):
-                fnMesh = om.MFnMesh(dagPath)
-                #  intersection test
-                try:
-                    hitPoint, hitRayParam, hitFace, hitTriangle, hitBary1, hitBary2 = fnMesh.closestIntersection(
-                        raySource, rayDirection, om.MSpace.kWorld, float('inf'), False
-                    )
-
-                    if hitPoint is not None:
-                        distance = (hitPoint - raySource).length()
-                        if distance < closestDistance:
-                            closestDistance = distance
-                            intersectionPoint = om.MPoint(hitPoint)
-                except:
-                    # If closestIntersection fails, just continue to the next mesh
-                    pass
+    @classmethod
+    def getMeshAccel(cls, dagPath, key=None):
+        """
+        Returns the mesh function set and intersection acceleration params of
+        the given mesh, creating and caching them on first use so Maya keeps
+        reusing the same acceleration grid for the mesh.
 
-            dagIterator.next()
+        Args:
+            dagPath (om.MDagPath): The DAG path of the mesh
+            key (tuple): The _pathKey of dagPath, if already known
 
-        return intersectionPoint  # This will be None if no intersection was found
+        Returns:
+            tuple: (om.MFnMesh, om.MMeshIsectAccelParams)
+        """
+        if key is None:
+            key = _pathKey(dagPath)
+        entry = cls._accelCache.get(key)
+        if entry is None:
+            # The outMesh callback registered with the scene BVH drops the entry
+            entry = (om.MFnMesh(dagPath), om.MFnMesh.autoUniformGridParams())
+            cls._accelCache[key] = entry
+        return entry
 
-    def isVisible(self, dagPath):
+    @classmethod
+    def getMeshTriangles(cls, dagPath, key=None):
         """
-        Check if the given DAG path (mesh or its transform) is visible.
+        Returns the world space triangles of the given mesh, collecting and
+        caching them on first use.
 
         Args:
-            dagPath (om.MDagPath): The DAG path to check
+            dagPath (om.MDagPath): The DAG path of the mesh
+            key (tuple): The _pathKey of dagPath, if already known
 
         Returns:
-            bool: True if the object is visible, False otherwise
-        """
-        # Check visibility of the shape node and all parent transforms
-        while dagPath.length() > 0:
-            currentNode = om.MFnDependencyNode(dagPath.node())
-
-            if currentNode.hasAttribute("visibility"):
-                visPlug = currentNode.findPlug("visibility", False)
-                if not visPlug.asBool():
-                    return False
-
-            # Check intermediate object attribute (for shapes)
-            if currentNode.hasAttribute("intermediateObject"):
-                intPlug = currentNode.findPlug("intermediateObject", False)
-                if intPlug.asBool():
-                    return False
-
-            # Move up
-            if dagPath.length() <= 1:
-                break
-            dagPath.pop(1)
-        return True
+            MeshTriangles: The triangles of the mesh
+        """
+        if key is None:
+            key = _pathKey(dagPath)
+        triangles = cls._triangleCache.get(key)
+        if triangles is None:
+            triangles = MeshTriangles.fromDagPath(dagPath)
+            cls._triangleCache[key] = triangles
+        return triangles
+
+    @classmethod
+    def clearMeshCache(cls, key=None):
+        """
+        Drops the cached acceleration params and triangles of one mesh, or of
+        all meshes if no key is given.
+
+        Args:
+            key (tuple): The _pathKey of the mesh
+        """
+        if key is None:
+            cls._accelCache.clear()
+            cls._triangleCache.clear()
+        else:
+            cls._accelCache.pop(key, None)
+            cls._triangleCache.pop(key, None)
 
 class RaySceneIntersectorCommand(om.MPxCommand):
     kCommandName = "raySceneIntersector"
 
     def __init__(self):
         super(RaySceneIntersectorCommand, self).__init__()
-        self.original_selection = []
+        self.original_selection = om.MSelectionList()
+        self.dgModifier = om.MDGModifier()
+        self.dagModifier = om.MDagModifier()
 
     @staticmethod
     def creator():
         return RaySceneIntersectorCommand()
 
+    def isUndoable(self):
+        return True
+
+    def undoIt(self):
+        # Connections live on the DG modifier, so it is undone before the locators go
+        self.dgModifier.undoIt()
+        self.dagModifier.undoIt()
+
+    def redoIt(self):
+        self.dagModifier.doIt()
+        self.dgModifier.doIt()
+
     def doIt(self, args):
         try:
-            #om.MGlobal.displayInfo("Starting raySceneIntersector command")
+            _LOG.debug("Starting raySceneIntersector command")
 
             # Store the original selection
-            self.original_selection = mc.ls(sl=True, l=True)
+            self.original_selection = om.MGlobal.getActiveSelectionList()
 
             argData = om.MArgDatabase(self.syntax(), args)
 
-            transforms = []
-            if argData.isFlagSet('-t'):
-                try:
-                    numUses = argData.numberOfFlagUses('-t')
-                    for j in range(numUses):
-                        arg_list = argData.getFlagArgumentList('-t', j)
-                        transform = arg_list.asString(0)
-                        transforms.append(transform)
-                except Exception as e:
-                    om.MGlobal.displayWarning(f"Error retrieving arguments for -t flag: {str(e)}")
-                #om.MGlobal.displayInfo(f"transforms: {transforms}")
+            transforms = self.getTransforms(argData)
 
-            else:
-                # If no transforms are provided, use the current selection
-                sel = mc.ls(sl=1, l=1)
-                for item in sel:
-                    if mc.nodeType(item) in ['joint', 'transform']:
-                        transforms.append(item)
-                    else:
-                        parents = mc.listRelatives(item, p=1)
-                        if parents:
-                            if mc.nodeType(parents[0]) in ['joint', 'transform']:
-                                transforms.append(parents[0])
-
-            #om.MGlobal.displayInfo(f"Final transforms list: {transforms}")
+            _LOG.debug("Final transforms list: %s", transforms)
 
             name = "rayIntersector1"
             if argData.isFlagSet('-n'):
                 name = argData.flagArgumentString('-n', 0)
 
-            #om.MGlobal.displayInfo(f"Name: {name}")
+            _LOG.debug("Name: %s", name)
 
             axis = 5
             if argData.isFlagSet('-a'):
                 axis = argData.flagArgumentInt('-a', 0)
+            if not 0 <= axis < len(RayIntersector._AXIS_TABLE):
+                raise ValueError(f"-axis must be 0 to 5 (X, Y, Z, -X, -Y, -Z), got {axis}")
 
-            #om.MGlobal.displayInfo(f"Axis: {axis}")
+            _LOG.debug("Axis: %s", axis)
 
-            # Perform the ray intersection for each transform
-            created_nodes = []
-            for i, transform in enumerate(transforms):
+            # Resolve every transform first, a bad name must fail the command
+            # before any node has been created
+            matrixPlugs = []
+            for transform in transforms:
+                selection = om.MSelectionList()
+                selection.add(transform)
+                transformFn = om.MFnDependencyNode(selection.getDependNode(0))
+                matrixPlugs.append(transformFn.findPlug("worldMatrix", False).elementByLogicalIndex(0))
+
+            # Queue all node creation, connections and attribute values on the
+            # modifiers so the whole command runs as one DG edit and undo step
+            created = []
+            for i, matrixPlug in enumerate(matrixPlugs):
                 node_name = f"{name}_{i + 1}" if i > 0 else name
-                ri = mc.createNode('rayIntersector', name=node_name)
-                loc = mc.spaceLocator(name=f"locator_{node_name}")[0]
-                mc.connectAttr(f"{transform}.worldMatrix[0]", f"{ri}.inputMatrix")
-                mc.connectAttr(f"{ri}.outputTranslate", f"{loc}.t")
-                mc.setAttr(f"{ri}.rayAxis", axis)
-                created_nodes.extend([ri, loc])
-
-            #om.MGlobal.displayInfo("Command execution completed")
+                ri = self.dgModifier.createNode(RayIntersector.kNodeId)
+                self.dgModifier.renameNode(ri, node_name)
+                loc = self.dagModifier.createNode("locator")
+                self.dagModifier.renameNode(loc, f"locator_{node_name}")
+                created.append((matrixPlug, ri, loc))
+            self.dgModifier.doIt()
+            self.dagModifier.doIt()
+
+            created_nodes = []
+            for matrixPlug, ri, loc in created:
+                riFn = om.MFnDependencyNode(ri)
+                locFn = om.MFnDagNode(loc)
+
+                self.dagModifier.renameNode(locFn.child(0), f"{locFn.name()}Shape")
+                self.dgModifier.connect(matrixPlug, riFn.findPlug("inputMatrix", False))
+                self.dgModifier.connect(riFn.findPlug("outputTranslate", False), locFn.findPlug("translate", False))
+                self.dgModifier.newPlugValueInt(riFn.findPlug("rayAxis", False), axis)
+                created_nodes.extend([riFn.name(), locFn.name()])
+            self.dagModifier.doIt()
+            self.dgModifier.doIt()
+
+            _LOG.debug("Command execution completed")
             self.setResult(created_nodes)
 
         except Exception as e:
             om.MGlobal.displayError(f"Error in raySceneIntersector command: {str(e)}")
             om.MGlobal.displayError(f"Error type: {type(e)}")
             om.MGlobal.displayError(f"Error args: {e.args}")
+            # A failed command never reaches the undo queue, so anything the
+            # modifiers already did has to be rolled back here
+            self.dgModifier.undoIt()
+            self.dagModifier.undoIt()
             raise
 
         finally:
-            # Restore the original selection
-            if self.original_selection:
-                try:
-                    mc.select(self.original_selection, replace=True)
-                except ValueError as ve:
-                    om.MGlobal.displayError(f"cannot restore selection")
-            else:
-                mc.select(clear=True)
+            # Restore the original selection (an empty list clears it)
+            try:
+                om.MGlobal.setActiveSelectionList(self.original_selection)
+            except RuntimeError:
+                om.MGlobal.displayError("cannot restore selection")
+
+    @staticmethod
+    def getTransforms(argData):
+        """
+        Returns the transforms given with the -t flag, or the selected
+        transforms (and the parents of selected shapes) if the flag isn't set.
+
+        Args:
+            argData (om.MArgDatabase): The parsed command arguments
+
+        Returns:
+            list: The transform names
+        """
+        transforms = []
+        if argData.isFlagSet('-t'):
+            try:
+                numUses = argData.numberOfFlagUses('-t')
+                for j in range(numUses):
+                    arg_list = argData.getFlagArgumentList('-t', j)
+                    transform = arg_list.asString(0)
+                    transforms.append(transform)
+            except Exception as e:
+                om.MGlobal.displayWarning(f"Error retrieving arguments for -t flag: {str(e)}")
+            _LOG.debug("transforms: %s", transforms)
+
+        else:
+            # If no transforms are provided, use the current selection
+            sel = mc.ls(sl=1, l=1)
+            for item in sel:
+                if mc.nodeType(item) in ['joint', 'transform']:
+                    transforms.append(item)
+                else:
+                    parents = mc.listRelatives(item, p=1)
+                    if parents:
+                        if mc.nodeType(parents[0]) in ['joint', 'transform']:
+                            transforms.append(parents[0])
+
+        return transforms
 
     @staticmethod
     def syntaxCreator():
@@ -289,7 +1228,91 @@ class RaySceneIntersectorCommand(om.MPxCommand):
             om.MGlobal.displayError(f"Error in syntaxCreator: {str(e)}")
         return syntax
 
+class RayIntersectorBatchCommand(om.MPxCommand):
+    """
+    Traces one ray per transform against the current scene and returns the
+    flattened world space hit positions (x, y, z per transform) without creating
+    any nodes. Transforms with no hit return their own position, like the node.
+    """
+    kCommandName = "rayIntersectorBatch"
+
+    def __init__(self):
+        super(RayIntersectorBatchCommand, self).__init__()
+
+    @staticmethod
+    def creator():
+        return RayIntersectorBatchCommand()
+
+    def doIt(self, args):
+        try:
+            argData = om.MArgDatabase(self.syntax(), args)
+
+            transforms = RaySceneIntersectorCommand.getTransforms(argData)
+
+            axis = 5
+            if argData.isFlagSet('-a'):
+                axis = argData.flagArgumentInt('-a', 0)
+            # Same values as the rayAxis enum of the node, negative ones would
+            # otherwise silently index the table from the end
+            if not 0 <= axis < len(RayIntersector._AXIS_TABLE):
+                raise ValueError(f"-axis must be 0 to 5 (X, Y, Z, -X, -Y, -Z), got {axis}")
+
+            if not transforms:
+                self.setResult([])
+                return
+
+            origins, directions = self.getRays(transforms, axis)
+
+            distances = getSceneBVH().closestTriangleHits(origins, directions)
+
+            hit = np.isfinite(distances)
+            positions = origins.copy()
+            positions[hit] += directions[hit] * distances[hit, None]
+            result = positions.ravel().tolist()
+
+            self.setResult(result)
+
+        except Exception as e:
+            om.MGlobal.displayError(f"Error in rayIntersectorBatch command: {str(e)}")
+            raise
+
+    @staticmethod
+    def getRays(transforms, axis):
+        """
+        Computes the ray origins and normalized directions of all transforms in
+        one pass over their stacked world matrices.
+
+        Args:
+            transforms (list): The transform names
+            axis (int): The rayAxis enum value used for every transform
+
+        Returns:
+            tuple: (origins, directions) as (N, 3) numpy arrays
+        """
+        matrices = []
+        for transform in transforms:
+            matrices.extend(mc.getAttr(f"{transform}.worldMatrix[0]"))
+        matrices = np.array(matrices, dtype=np.float64).reshape(len(transforms), 4, 4)
+
+        row, sign = RayIntersector._AXIS_TABLE[axis]
+        origins = matrices[:, 3, :3]
+        directions = sign * matrices[:, row, :3]
+        directions /= np.linalg.norm(directions, axis=1, keepdims=True)
+        return origins, directions
+
+    @staticmethod
+    def syntaxCreator():
+        syntax = om.MSyntax()
+        try:
+            syntax.addFlag('-t', '-transforms', om.MSyntax.kString)
+            syntax.makeFlagMultiUse('-t')
+            syntax.addFlag('-a', '-axis', om.MSyntax.kLong)
+        except Exception as e:
+            om.MGlobal.displayError(f"Error in syntaxCreator: {str(e)}")
+        return syntax
+
 def initializePlugin(plugin):
+    global _visibilityAttributes
     vendor = "computerologist"
     version = "0.1"
 
@@ -298,15 +1321,30 @@ def initializePlugin(plugin):
         pluginFn.registerNode(RayIntersector.kNodeName, RayIntersector.kNodeId, 
                               RayIntersector.creator, RayIntersector.initialize, om.MPxNode.kDependNode)
         pluginFn.registerCommand(RaySceneIntersectorCommand.kCommandName, RaySceneIntersectorCommand.creator, RaySceneIntersectorCommand.syntaxCreator)
+        pluginFn.registerCommand(RayIntersectorBatchCommand.kCommandName, RayIntersectorBatchCommand.creator, RayIntersectorBatchCommand.syntaxCreator)
     except:
-        om.MGlobal.displayError(f"Failed to register node: {RayIntersector.kNodeName} or command: {RaySceneIntersectorCommand.kCommandName}")
+        om.MGlobal.displayError(f"Failed to register node: {RayIntersector.kNodeName} or commands: {RaySceneIntersectorCommand.kCommandName}, {RayIntersectorBatchCommand.kCommandName}")
         raise
 
+    # Any reparenting, instancing or deletion in the DAG invalidates the scene BVH
+    _sceneCallbackIds.append(om.MDagMessage.addAllDagChangesCallback(_onSceneChanged))
+
+    dagNodeClass = om.MNodeClass("dagNode")
+    _visibilityAttributes = tuple(dagNodeClass.attribute(name) for name in SceneBVH.kVisibilityAttributes)
+
 def uninitializePlugin(plugin):
+    invalidateSceneBVH()
+    invalidateVisibility()
+    RayIntersector.clearMeshCache()
+    om.MMessage.removeCallbacks(_sceneCallbackIds + _staleCallbackIds)
+    del _sceneCallbackIds[:]
+    del _staleCallbackIds[:]
+
     pluginFn = om.MFnPlugin(plugin)
     try:
         pluginFn.deregisterNode(RayIntersector.kNodeId)
         pluginFn.deregisterCommand(RaySceneIntersectorCommand.kCommandName)
+        pluginFn.deregisterCommand(RayIntersectorBatchCommand.kCommandName)
     except:
-        om.MGlobal.displayError(f"Failed to deregister node: {RayIntersector.kNodeName} or command: {RaySceneIntersectorCommand.kCommandName}")
+        om.MGlobal.displayError(f"Failed to deregister node: {RayIntersector.kNodeName} or commands: {RaySceneIntersectorCommand.kCommandName}, {RayIntersectorBatchCommand.kCommandName}")
         raise
\ No newline at end of file
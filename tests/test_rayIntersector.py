@@ -0,0 +1,227 @@
+"""
+Checks the BVH and triangle kernels of rayIntersector against brute force
+slab and Moeller-Trumbore tests. They only use NumPy (and Numba if present),
+so Maya is replaced by stub modules when it can't be imported; every test
+runs once with the Numba kernels and once with the NumPy fallback.
+
+Run with: python -m unittest discover tests
+"""
+
+import importlib.util
+import os
+import sys
+import types
+import unittest
+
+import numpy as np
+
+_MODULE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "rayIntersector.py")
+
+class _StubType(type):
+    """
+    Stand in for the Maya classes: any class attribute (enum values, nested
+    classes) reads as 0 and instances accept any constructor arguments.
+    """
+    def __getattr__(cls, name):
+        return 0
+
+def _stubModule(name):
+    module = types.ModuleType(name)
+    module.__getattr__ = lambda attr: _StubType(attr, (object,), {"__init__": lambda self, *args, **kwargs: None})
+    return module
+
+def _installMayaStubs():
+    try:
+        import maya.api.OpenMaya  # noqa: F401
+        return
+    except ImportError:
+        pass
+    maya = types.ModuleType("maya")
+    api = types.ModuleType("maya.api")
+    maya.api = api
+    api.OpenMaya = _stubModule("maya.api.OpenMaya")
+    maya.cmds = _stubModule("maya.cmds")
+    sys.modules.update({"maya": maya, "maya.api": api,
+                        "maya.api.OpenMaya": api.OpenMaya, "maya.cmds": maya.cmds})
+
+def _loadRayIntersector(name, withNumba):
+    """
+    Imports a fresh copy of rayIntersector under the given name, hiding
+    Numba from it if withNumba is False.
+    """
+    _installMayaStubs()
+    spec = importlib.util.spec_from_file_location(name, _MODULE_PATH)
+    module = importlib.util.module_from_spec(spec)
+    # Numba's on disk cache re-imports the module by name when loading kernels
+    sys.modules[name] = module
+    hidden = "numba" in sys.modules, sys.modules.get("numba")
+    if not withNumba:
+        sys.modules["numba"] = None
+    try:
+        spec.loader.exec_module(module)
+    finally:
+        if not withNumba:
+            if hidden[0]:
+                sys.modules["numba"] = hidden[1]
+            else:
+                del sys.modules["numba"]
+    return module
+
+def _bruteForceSlab(boundsMin, boundsMax, ro, rd):
+    """
+    Returns the hit flag and entry distance of the ray for every box.
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        invdir = 1.0 / rd
+        t1 = (boundsMin - ro) * invdir
+        t2 = (boundsMax - ro) * invdir
+    tnear = np.minimum(t1, t2).max(axis=1)
+    tfar = np.maximum(t1, t2).min(axis=1)
+    return (tnear <= tfar) & (tfar >= 0.0), tnear
+
+def _bruteForceTriangles(v0, v1, v2, ro, rd):
+    """
+    Returns the distance to the closest triangle hit by the ray, inf if none.
+    """
+    e1 = v1 - v0
+    e2 = v2 - v0
+    pvec = np.cross(rd, e2)
+    det = np.einsum("ij,ij->i", e1, pvec)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        invDet = 1.0 / det
+        tvec = ro - v0
+        u = np.einsum("ij,ij->i", tvec, pvec) * invDet
+        qvec = np.cross(tvec, e1)
+        v = qvec.dot(rd) * invDet
+        t = np.einsum("ij,ij->i", e2, qvec) * invDet
+        hit = (np.abs(det) > 1e-12) & (u >= 0.0) & (v >= 0.0) & (u + v <= 1.0) & (t > 0.0)
+    return t[hit].min() if hit.any() else np.inf
+
+def _randomRays(rng, count, extent):
+    origins = rng.uniform(-extent, extent, (count, 3))
+    directions = rng.normal(size=(count, 3))
+    # Axis aligned rays exercise the infinite reciprocals of the slab test
+    directions[::10] = (0.0, 0.0, 1.0)
+    directions[5::10] = (-1.0, 0.0, 0.0)
+    directions /= np.linalg.norm(directions, axis=1, keepdims=True)
+    return origins, directions
+
+class _KernelTests(object):
+    kWithNumba = None
+
+    @classmethod
+    def setUpClass(cls):
+        # The Numba copy keeps the real name, it shares the kernel cache with
+        # the plugin; the fallback compiles nothing
+        name = "rayIntersector" if cls.kWithNumba else "rayIntersector_numpy"
+        cls.ri = _loadRayIntersector(name, cls.kWithNumba)
+
+    def setUp(self):
+        self.rng = np.random.default_rng(7)
+
+    def randomBoxes(self, count):
+        centers = self.rng.uniform(-20.0, 20.0, (count, 3))
+        sizes = self.rng.uniform(0.5, 4.0, (count, 3))
+        return centers - sizes, centers + sizes
+
+    def test_traverseVisitsEveryEnteredLeaf(self):
+        boundsMin, boundsMax = self.randomBoxes(150)
+        # Leaf size 1, dagPaths[leaf] is the index of the box in the leaf
+        bvh = self.ri.SceneBVH.fromBounds(boundsMin, boundsMax, list(range(150)), [])
+        origins, directions = _randomRays(self.rng, 200, 30.0)
+        for ro, rd in zip(origins, directions):
+            visited = []
+
+            def intersectLeaf(index, maxDistance):
+                visited.append(bvh.dagPaths[index])
+                return None
+
+            bvh.traverse(ro, self.ri._reciprocal(rd), intersectLeaf)
+            hit, _ = _bruteForceSlab(boundsMin, boundsMax, ro, rd)
+            self.assertEqual(sorted(visited), np.flatnonzero(hit).tolist())
+
+    def test_traverseFindsClosestLeaf(self):
+        boundsMin, boundsMax = self.randomBoxes(150)
+        bvh = self.ri.SceneBVH.fromBounds(boundsMin, boundsMax, list(range(150)), [])
+        origins, directions = _randomRays(self.rng, 200, 30.0)
+        for ro, rd in zip(origins, directions):
+            hit, tnear = _bruteForceSlab(boundsMin, boundsMax, ro, rd)
+            entry = np.maximum(tnear, 0.0)
+
+            def intersectLeaf(index, maxDistance):
+                box = bvh.dagPaths[index]
+                return entry[box], box
+
+            distance, box = bvh.traverse(ro, self.ri._reciprocal(rd), intersectLeaf)
+            if hit.any():
+                self.assertAlmostEqual(distance, entry[hit].min())
+                self.assertEqual(entry[box], entry[hit].min())
+            else:
+                self.assertIsNone(box)
+
+    def test_candidateLeaves(self):
+        boundsMin, boundsMax = self.randomBoxes(150)
+        bvh = self.ri.SceneBVH.fromBounds(boundsMin, boundsMax, list(range(150)), [])
+        leafMask = self.rng.random(150) < 0.7
+        origins, directions = _randomRays(self.rng, 200, 30.0)
+        rays, leaves = bvh.candidateLeaves(origins, self.ri._reciprocal(directions), leafMask)
+
+        boxes = np.array(bvh.dagPaths)
+        for ray, (ro, rd) in enumerate(zip(origins, directions)):
+            hit, _ = _bruteForceSlab(boundsMin, boundsMax, ro, rd)
+            expected = sorted(int(boxes[leaf]) for leaf in np.flatnonzero(leafMask) if hit[boxes[leaf]])
+            self.assertEqual(sorted(boxes[leaves[rays == ray]].tolist()), expected)
+
+    def test_closestHits(self):
+        # Stored as float32 by MeshTriangles, so compare against the same vertices
+        centers = self.rng.uniform(-10.0, 10.0, (400, 1, 3))
+        triangles = (centers + self.rng.uniform(-2.0, 2.0, (400, 3, 3))).astype(np.float32).astype(np.float64)
+        v0, v1, v2 = triangles[:, 0], triangles[:, 1], triangles[:, 2]
+        mesh = self.ri.MeshTriangles(v0, v1, v2)
+
+        origins, directions = _randomRays(self.rng, 300, 15.0)
+        distances = mesh.closestHits(origins, directions, self.ri._reciprocal(directions),
+                                     np.full(len(origins), np.inf))
+        expected = np.array([_bruteForceTriangles(v0, v1, v2, ro, rd) for ro, rd in zip(origins, directions)])
+
+        self.assertTrue(np.isfinite(expected).sum() > 20)
+        np.testing.assert_array_equal(np.isinf(distances), np.isinf(expected))
+        hit = np.isfinite(expected)
+        np.testing.assert_allclose(distances[hit], expected[hit], rtol=1e-4, atol=1e-4)
+
+    def test_closestHitsRespectsMaxDistance(self):
+        triangles = self.rng.uniform(-10.0, 10.0, (200, 3, 3)).astype(np.float32).astype(np.float64)
+        v0, v1, v2 = triangles[:, 0], triangles[:, 1], triangles[:, 2]
+        mesh = self.ri.MeshTriangles(v0, v1, v2)
+
+        origins, directions = _randomRays(self.rng, 200, 10.0)
+        maxDistances = self.rng.uniform(0.0, 20.0, len(origins))
+        distances = mesh.closestHits(origins, directions, self.ri._reciprocal(directions), maxDistances.copy())
+        expected = np.array([_bruteForceTriangles(v0, v1, v2, ro, rd) for ro, rd in zip(origins, directions)])
+
+        beyond = expected >= maxDistances * (1.0 + 1e-4)
+        np.testing.assert_array_equal(distances[beyond], maxDistances[beyond])
+        within = expected < maxDistances * (1.0 - 1e-4)
+        np.testing.assert_allclose(distances[within], expected[within], rtol=1e-4, atol=1e-4)
+
+    def test_emptyMesh(self):
+        empty = np.zeros((0, 3))
+        mesh = self.ri.MeshTriangles(empty, empty, empty)
+        origins, directions = _randomRays(self.rng, 4, 1.0)
+        distances = mesh.closestHits(origins, directions, self.ri._reciprocal(directions), np.full(4, np.inf))
+        self.assertTrue(np.isinf(distances).all())
+
+try:
+    import numba  # noqa: F401
+except ImportError:
+    numba = None
+
+@unittest.skipIf(numba is None, "numba is not installed")
+class NumbaKernelTests(_KernelTests, unittest.TestCase):
+    kWithNumba = True
+
+class NumPyKernelTests(_KernelTests, unittest.TestCase):
+    kWithNumba = False
+
+if __name__ == "__main__":
+    unittest.main()